@@ -0,0 +1,20 @@
+"""
+This module provides the FastAPI dependencies shared by the API routes.
+
+The OpenAI service is stateless between requests, so a single instance is
+created on first use and reused for every subsequent request.
+"""
+from functools import lru_cache
+
+from .services.openai_service import OpenAIService
+
+
+@lru_cache(maxsize=1)
+def get_openai_service() -> OpenAIService:
+    """
+    Returns the shared OpenAIService instance.
+
+    Returns:
+        OpenAIService: The service used to interact with the OpenAI API.
+    """
+    return OpenAIService()
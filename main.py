@@ -1,10 +1,15 @@
-from fastapi import FastAPI, HTTPException
+import os
+from functools import lru_cache
+
+import orjson
+from fastapi import FastAPI, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
+from starlette.middleware.base import BaseHTTPMiddleware
 from .routes import router
 from .config import Config
 from .services import openai_service
 from .utils import openai_utils
-from .models import base
 from . import dependencies
 
 app = FastAPI(
@@ -14,38 +19,102 @@ app = FastAPI(
     debug=Config.DEBUG,
 )
 
-# Configure CORS for cross-origin requests
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+def add_asgi_middleware(app: FastAPI, middleware_class: type, **options) -> None:
+    """
+    Adds a pure ASGI middleware to the application.
+
+    Middleware derived from `BaseHTTPMiddleware` is rejected: it allocates a task
+    group, memory streams and a cached request for every call, which adds latency
+    to all requests passing through it.
+
+    Args:
+        app (FastAPI): The application to add the middleware to.
+        middleware_class (type): The ASGI middleware class.
+        **options: Keyword arguments passed to the middleware constructor.
+
+    Raises:
+        TypeError: If `middleware_class` is a `BaseHTTPMiddleware` subclass.
+    """
+    if issubclass(middleware_class, BaseHTTPMiddleware):
+        raise TypeError(
+            f"{middleware_class.__name__} derives from BaseHTTPMiddleware; "
+            "only pure ASGI middleware may be added."
+        )
+    app.add_middleware(middleware_class, **options)
+
+# Configure CORS for cross-origin requests. Outside debug mode the allowed
+# origins, methods and headers are explicit lists, so preflight requests are
+# answered without echoing the request headers back.
+if Config.DEBUG:
+    add_asgi_middleware(
+        app,
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+else:
+    add_asgi_middleware(
+        app,
+        CORSMiddleware,
+        allow_origins=[
+            origin.strip()
+            for origin in os.getenv("ALLOWED_ORIGINS", "").split(",")
+            if origin.strip()
+        ],
+        allow_credentials=True,
+        allow_methods=["POST"],
+        allow_headers=["Authorization", "Content-Type"],
+    )
 
 # Include routes defined in the 'routes.py' module
 app.include_router(router)
 
 @app.on_event("startup")
 async def startup_event():
-    await base.database.connect()
+    openai_service.batcher.start()
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    await base.database.disconnect()
+    await openai_service.batcher.stop()
+    await openai_utils.client.close()
+
+@lru_cache(maxsize=8)
+def _encode_error(detail: str) -> bytes:
+    """Encodes an error body, reusing it while the same message keeps recurring."""
+    return orjson.dumps({"detail": detail})
+
+def _error_response(detail, status_code: int, headers=None) -> Response:
+    """Builds a JSON error response without going through jsonable_encoder."""
+    if isinstance(detail, str):
+        return Response(
+            content=_encode_error(detail),
+            status_code=status_code,
+            headers=headers,
+            media_type="application/json",
+        )
+    return ORJSONResponse({"detail": detail}, status_code=status_code, headers=headers)
 
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request, exc):
-    return {
-        "detail": exc.detail,
-    }
+    return _error_response(exc.detail, exc.status_code, exc.headers)
 
 @app.exception_handler(Exception)
 async def general_exception_handler(request, exc):
-    return {
-        "detail": f"An unexpected error occurred: {exc}",
-    }
+    return _error_response(f"An unexpected error occurred: {exc}", 500)
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+
+    # Auto-reload only works with a single worker, so keep it to debug runs.
+    reload = Config.DEBUG
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        reload=reload,
+        workers=None if reload else 2 * (os.cpu_count() or 1) + 1,
+    )
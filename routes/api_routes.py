@@ -1,135 +1,193 @@
-from fastapi import APIRouter, HTTPException, Depends
-from fastapi.responses import JSONResponse
-from typing import Dict, Optional
+import msgspec
+import orjson
+from fastapi import APIRouter, Depends, Header, HTTPException, Request
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from typing import Optional, Type, TypeVar
 
 from .services import openai_service
 from .dependencies import get_openai_service
 
-router = APIRouter(prefix="/api", tags=["OpenAI API"])
+# Responses are encoded by orjson straight into a single bytes object that the
+# Response holds as its body. Pooling bytearray buffers would only add a copy
+# (bytearray -> bytes) per response, so none is used.
+router = APIRouter(
+    prefix="/api",
+    tags=["OpenAI API"],
+    default_response_class=ORJSONResponse,
+)
+
+
+class GenerationParams(msgspec.Struct):
+    """
+    Request body shared by the text generation and code completion endpoints.
+
+    When `model` is omitted, each endpoint falls back to its own default model.
+    When `stream` is set, the completion is returned as newline-delimited JSON
+    `{"delta": ...}` objects as OpenAI generates it.
+    """
+
+    prompt: str
+    model: Optional[str] = None
+    max_tokens: Optional[int] = None
+    temperature: float = 0.7
+    top_p: Optional[float] = None
+    frequency_penalty: float = 0.0
+    presence_penalty: float = 0.0
+    stop: Optional[str] = None
+    stream: bool = False
+
+
+class TranslationParams(msgspec.Struct):
+    """Request body for the translation endpoint."""
+
+    text: str
+    target_language: str
+    model: str = "gpt-3.5-turbo"
+
+
+ParamsT = TypeVar("ParamsT", bound=msgspec.Struct)
+
+
+async def _decode_body(request: Request, params_type: Type[ParamsT]) -> ParamsT:
+    """
+    Decodes and validates a JSON request body in a single msgspec pass.
+
+    Raises:
+        HTTPException: With status 422 if the body is malformed or invalid.
+    """
+    try:
+        return msgspec.json.decode(await request.body(), type=params_type)
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=422, detail=f"Invalid request body: {e}")
+
+
+async def _stream_completion(
+    openai_service: openai_service.OpenAIService,
+    params: GenerationParams,
+    model: str,
+) -> StreamingResponse:
+    """Streams a completion to the client as newline-delimited JSON deltas."""
+    deltas = await openai_service.stream_completion(
+        params.prompt,
+        model=model,
+        max_tokens=params.max_tokens,
+        temperature=params.temperature,
+        top_p=params.top_p,
+        frequency_penalty=params.frequency_penalty,
+        presence_penalty=params.presence_penalty,
+        stop=params.stop,
+    )
+    return StreamingResponse(
+        (orjson.dumps({"delta": delta}) + b"\n" async for delta in deltas),
+        media_type="application/x-ndjson",
+    )
+
 
 @router.post("/generate_text")
 async def generate_text(
-    prompt: str,
-    model: str = "text-davinci-003",
-    max_tokens: Optional[int] = None,
-    temperature: float = 0.7,
-    top_p: Optional[float] = None,
-    frequency_penalty: float = 0.0,
-    presence_penalty: float = 0.0,
-    stop: Optional[str] = None,
+    request: Request,
+    allow_coalescing: bool = Header(False, alias="X-Allow-Coalescing"),
+    allow_batching: bool = Header(False, alias="X-Allow-Batching"),
     openai_service: openai_service.OpenAIService = Depends(get_openai_service),
 ):
     """
     Generates text using the OpenAI API.
 
+    The JSON body is decoded into `GenerationParams`; `model` defaults to
+    "text-davinci-003".
+
     Args:
-        prompt (str): The prompt to use for text generation.
-        model (str, optional): The OpenAI model to use. Defaults to "text-davinci-003".
-        max_tokens (int, optional): The maximum number of tokens to generate. Defaults to None.
-        temperature (float, optional): The temperature to use for sampling. Defaults to 0.7.
-        top_p (float, optional): The top_p value for sampling. Defaults to None.
-        frequency_penalty (float, optional): The frequency penalty to use. Defaults to 0.0.
-        presence_penalty (float, optional): The presence penalty to use. Defaults to 0.0.
-        stop (str, optional): A sequence of strings to stop generation at. Defaults to None.
+        request (Request): The incoming request carrying the JSON body.
+        allow_coalescing (bool, optional): Read from the `X-Allow-Coalescing` header; lets
+            identical concurrent requests share one OpenAI call even when temperature > 0.
+            Defaults to False.
+        allow_batching (bool, optional): Read from the `X-Allow-Batching` header; lets the
+            prompt be answered together with other concurrent prompts in one OpenAI call.
+            The prompt is then treated as a question to answer rather than text to
+            continue. Requires `max_tokens`. Defaults to False.
 
     Returns:
-        JSONResponse: A JSON response containing the generated text.
+        ORJSONResponse: A JSON response containing the generated text, or a
+            StreamingResponse of NDJSON deltas when `stream` is set.
 
     Raises:
-        HTTPException: If an error occurs during API interaction.
+        HTTPException: If the body is invalid or an error occurs during API interaction.
     """
-    try:
-        response = await openai_service.generate_text(
-            prompt,
-            model,
-            max_tokens,
-            temperature,
-            top_p,
-            frequency_penalty,
-            presence_penalty,
-            stop,
-        )
-        return JSONResponse(response)
-    except openai.error.APIError as e:
-        raise HTTPException(status_code=500, detail=f"OpenAI API Error: {e}")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error generating text: {e}")
+    params = await _decode_body(request, GenerationParams)
+    if params.stream:
+        return await _stream_completion(openai_service, params, params.model or "text-davinci-003")
+    response = await openai_service.generate_text(
+        params.prompt,
+        model=params.model or "text-davinci-003",
+        max_tokens=params.max_tokens,
+        temperature=params.temperature,
+        top_p=params.top_p,
+        frequency_penalty=params.frequency_penalty,
+        presence_penalty=params.presence_penalty,
+        stop=params.stop,
+        coalesce=allow_coalescing,
+        batch=allow_batching,
+    )
+    return ORJSONResponse(response)
 
 @router.post("/translate_text")
 async def translate_text(
-    text: str,
-    target_language: str,
-    model: str = "gpt-3.5-turbo",
+    request: Request,
     openai_service: openai_service.OpenAIService = Depends(get_openai_service),
 ):
     """
     Translates text using the OpenAI API.
 
+    The JSON body is decoded into `TranslationParams`; `model` defaults to
+    "gpt-3.5-turbo".
+
     Args:
-        text (str): The text to translate.
-        target_language (str): The target language code (e.g., "fr" for French).
-        model (str, optional): The OpenAI model to use. Defaults to "gpt-3.5-turbo".
+        request (Request): The incoming request carrying the JSON body.
 
     Returns:
-        JSONResponse: A JSON response containing the translated text.
+        ORJSONResponse: A JSON response containing the translated text.
 
     Raises:
-        HTTPException: If an error occurs during API interaction.
+        HTTPException: If the body is invalid or an error occurs during API interaction.
     """
-    try:
-        response = await openai_service.translate_text(
-            text, target_language, model
-        )
-        return JSONResponse(response)
-    except openai.error.APIError as e:
-        raise HTTPException(status_code=500, detail=f"OpenAI API Error: {e}")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error translating text: {e}")
+    params = await _decode_body(request, TranslationParams)
+    response = await openai_service.translate_text(
+        params.text, params.target_language, params.model
+    )
+    return ORJSONResponse(response)
 
 @router.post("/complete_code")
 async def complete_code(
-    prompt: str,
-    model: str = "code-davinci-002",
-    max_tokens: Optional[int] = None,
-    temperature: float = 0.7,
-    top_p: Optional[float] = None,
-    frequency_penalty: float = 0.0,
-    presence_penalty: float = 0.0,
-    stop: Optional[str] = None,
+    request: Request,
     openai_service: openai_service.OpenAIService = Depends(get_openai_service),
 ):
     """
     Completes code using the OpenAI API.
 
+    The JSON body is decoded into `GenerationParams`; `model` defaults to
+    "code-davinci-002".
+
     Args:
-        prompt (str): The prompt to use for code completion.
-        model (str, optional): The OpenAI model to use. Defaults to "code-davinci-002".
-        max_tokens (int, optional): The maximum number of tokens to generate. Defaults to None.
-        temperature (float, optional): The temperature to use for sampling. Defaults to 0.7.
-        top_p (float, optional): The top_p value for sampling. Defaults to None.
-        frequency_penalty (float, optional): The frequency penalty to use. Defaults to 0.0.
-        presence_penalty (float, optional): The presence penalty to use. Defaults to 0.0.
-        stop (str, optional): A sequence of strings to stop generation at. Defaults to None.
+        request (Request): The incoming request carrying the JSON body.
 
     Returns:
-        JSONResponse: A JSON response containing the completed code.
+        ORJSONResponse: A JSON response containing the completed code, or a
+            StreamingResponse of NDJSON deltas when `stream` is set.
 
     Raises:
-        HTTPException: If an error occurs during API interaction.
+        HTTPException: If the body is invalid or an error occurs during API interaction.
     """
-    try:
-        response = await openai_service.complete_code(
-            prompt,
-            model,
-            max_tokens,
-            temperature,
-            top_p,
-            frequency_penalty,
-            presence_penalty,
-            stop,
-        )
-        return JSONResponse(response)
-    except openai.error.APIError as e:
-        raise HTTPException(status_code=500, detail=f"OpenAI API Error: {e}")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error completing code: {e}")
\ No newline at end of file
+    params = await _decode_body(request, GenerationParams)
+    if params.stream:
+        return await _stream_completion(openai_service, params, params.model or "code-davinci-002")
+    response = await openai_service.complete_code(
+        params.prompt,
+        model=params.model or "code-davinci-002",
+        max_tokens=params.max_tokens,
+        temperature=params.temperature,
+        top_p=params.top_p,
+        frequency_penalty=params.frequency_penalty,
+        presence_penalty=params.presence_penalty,
+        stop=params.stop,
+    )
+    return ORJSONResponse(response)
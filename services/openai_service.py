@@ -15,19 +15,250 @@ This module adheres to the following design principles:
 - **Robustness:** Implements error handling for potential API failures and data inconsistencies.
 - **Scalability:**  The code is designed for future expansion and handling increased request volumes.
 """
+import asyncio
 import os
-from typing import Dict, Any, Optional
+import re
+import secrets
+from collections import defaultdict
+from typing import Dict, Any, AsyncIterator, Iterable, List, Optional, Tuple
 
 import openai
 from fastapi import HTTPException
 
+from .services import sem_cache
 from .utils import openai_utils
 
-# Load environment variables from .env
-from .config import Config
+# Completion batching limits: at most this many prompts per upstream call,
+# collected over at most this many seconds.
+BATCH_MAX_SIZE = 8
+BATCH_MAX_WAIT_SECONDS = 0.25
 
-# Initialize the OpenAI API client
-openai.api_key = Config.OPENAI_API_KEY
+_COMPLETION_ERRORS = {
+    "text": "Error generating text",
+    "code": "Error completing code",
+}
+
+def _answer_marker(nonce: str) -> "re.Pattern[str]":
+    """Matches the label that starts an answer within one batch."""
+    return re.compile(rf"^\s*\[{nonce}-(\d+)\]\s*", re.MULTILINE)
+
+
+def _frame_prompts(prompts: List[str], nonce: str) -> str:
+    """
+    Combines several prompts into a single labelled "answer each" prompt.
+
+    Labels carry a random per-batch nonce, so text inside one caller's prompt
+    cannot be mistaken for the start of another caller's answer.
+    """
+    labelled = "\n".join(f"[{nonce}-{index}] {prompt}" for index, prompt in enumerate(prompts, 1))
+    return (
+        "Answer each of the following prompts independently. Start every answer "
+        f"on a new line with the label of its prompt, e.g. [{nonce}-1].\n\n"
+        f"{labelled}\n\nAnswers:\n"
+    )
+
+
+def _split_answers(
+    text: str, count: int, nonce: str, truncated: bool = False
+) -> List[Optional[str]]:
+    """
+    Splits a reply to a framed prompt back into its individual answers.
+
+    Answers that cannot be located in the reply, or whose label appears more
+    than once, are returned as None. When the reply was cut off at max_tokens,
+    the last answer in it may be incomplete and is returned as None as well.
+    """
+    answers: List[Optional[str]] = [None] * count
+    seen = [0] * count
+    parts = _answer_marker(nonce).split(text)
+    last = None
+    for number, answer in zip(parts[1::2], parts[2::2]):
+        index = int(number) - 1
+        if 0 <= index < count:
+            seen[index] += 1
+            answers[index] = answer.strip()
+            last = index
+    if truncated and last is not None:
+        answers[last] = None
+    return [answer if times == 1 else None for answer, times in zip(answers, seen)]
+
+
+def _fail_unanswered(futures: Iterable[asyncio.Future]) -> None:
+    """Fails every future that has not been resolved yet."""
+    for future in futures:
+        if not future.done():
+            future.set_exception(RuntimeError("Completion batcher stopped before answering"))
+
+
+async def _iter_deltas(stream: openai.AsyncStream) -> AsyncIterator[str]:
+    """Yields the text of each streamed completion chunk, closing the stream when done."""
+    try:
+        async for chunk in stream:
+            if chunk.choices:
+                yield chunk.choices[0].text
+    finally:
+        await stream.close()
+
+
+class CompletionBatcher:
+    """
+    Coalesces concurrent text generation requests into shared Completion calls.
+
+    Only callers that opt in are batched, since the combined prompt frames each
+    prompt as a question to answer rather than text to continue. Prompts queued
+    within `max_wait` seconds of each other that share the same sampling
+    parameters are sent to OpenAI as one numbered prompt, and the reply
+    is split back out to the individual callers. Any prompt whose answer cannot
+    be recovered from the combined reply, or may have been truncated, is retried
+    on its own. Only prompts with an explicit max_tokens are submitted.
+    """
+
+    def __init__(
+        self,
+        max_batch_size: int = BATCH_MAX_SIZE,
+        max_wait: float = BATCH_MAX_WAIT_SECONDS,
+    ):
+        """Initializes the CompletionBatcher."""
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._dispatches: set = set()
+
+    @property
+    def running(self) -> bool:
+        """Whether the background batching task is active."""
+        return self._task is not None and not self._task.done()
+
+    def start(self) -> None:
+        """Starts the background batching task on the running event loop."""
+        if not self.running:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stops the background batching task.
+
+        Prompts still waiting in the queue, and prompts in batches that are still
+        being answered, fail with RuntimeError so their callers do not wait forever.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._queue is not None:
+            while not self._queue.empty():
+                _, future, _ = self._queue.get_nowait()
+                _fail_unanswered([future])
+        dispatches = list(self._dispatches)
+        for task in dispatches:
+            task.cancel()
+        await asyncio.gather(*dispatches, return_exceptions=True)
+
+    async def submit(self, prompt: str, params: Tuple) -> str:
+        """
+        Queues a prompt for batching and waits for its answer.
+
+        Args:
+            prompt (str): The prompt to use for text generation.
+            params (Tuple): The (model, max_tokens, temperature, top_p,
+                frequency_penalty, presence_penalty) sampling parameters.
+
+        Returns:
+            str: The generated text for this prompt.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((prompt, future, params))
+        return await future
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            try:
+                while len(batch) < self.max_batch_size:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+            except asyncio.CancelledError:
+                _fail_unanswered(future for _, future, _ in batch)
+                raise
+
+            groups = defaultdict(list)
+            for prompt, future, params in batch:
+                groups[params].append((prompt, future))
+            for params, items in groups.items():
+                task = asyncio.create_task(self._dispatch(params, items))
+                self._dispatches.add(task)
+                task.add_done_callback(self._dispatches.discard)
+
+    async def _dispatch(self, params: Tuple, items: List[Tuple[str, asyncio.Future]]) -> None:
+        try:
+            await self._answer(params, items)
+        finally:
+            _fail_unanswered(future for _, future in items)
+
+    async def _answer(self, params: Tuple, items: List[Tuple[str, asyncio.Future]]) -> None:
+        model, max_tokens, temperature, top_p, frequency_penalty, presence_penalty = params
+        try:
+            if len(items) == 1:
+                response = await openai_utils.generate_text(
+                    items[0][0],
+                    model=model,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    top_p=top_p,
+                    frequency_penalty=frequency_penalty,
+                    presence_penalty=presence_penalty,
+                )
+                answers = [response.choices[0].text]
+            else:
+                nonce = secrets.token_hex(4)
+                response = await openai_utils.generate_text(
+                    _frame_prompts([prompt for prompt, _ in items], nonce),
+                    model=model,
+                    max_tokens=max_tokens * len(items),
+                    temperature=temperature,
+                    top_p=top_p,
+                    frequency_penalty=frequency_penalty,
+                    presence_penalty=presence_penalty,
+                )
+                answers = _split_answers(
+                    response.choices[0].text,
+                    len(items),
+                    nonce,
+                    truncated=response.choices[0].finish_reason == "length",
+                )
+        except Exception as e:
+            for _, future in items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        unanswered = []
+        for item, answer in zip(items, answers):
+            if answer is None:
+                unanswered.append(item)
+            elif not item[1].done():
+                item[1].set_result(answer)
+        if unanswered:
+            await asyncio.gather(*(self._dispatch(params, [item]) for item in unanswered))
+
+
+batcher = CompletionBatcher()
+
+semantic_cache = sem_cache.SemanticCache(
+    enabled=os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true",
+)
 
 
 class OpenAIService:
@@ -41,95 +272,186 @@ class OpenAIService:
 
     def __init__(self):
         """Initializes the OpenAIService."""
-        self.openai_utils = openai_utils.OpenAIUtils()
+        self._inflight: Dict[Tuple, asyncio.Future] = {}
 
-    async def generate_text(
+    async def _completion(
         self,
         prompt: str,
-        model: str = "text-davinci-003",
+        *,
+        model: str,
+        key: str,
+        batch: bool = False,
         max_tokens: Optional[int] = None,
         temperature: float = 0.7,
         top_p: Optional[float] = None,
         frequency_penalty: float = 0.0,
         presence_penalty: float = 0.0,
         stop: Optional[str] = None,
+        coalesce: bool = False,
     ) -> Dict[str, Any]:
         """
-        Generates text using the OpenAI API.
+        Creates a completion using the OpenAI API.
+
+        Concurrent calls with identical arguments share a single upstream request
+        when sampling is deterministic (temperature 0) or when `coalesce` is set.
 
         Args:
-            prompt (str): The prompt to use for text generation.
-            model (str, optional): The OpenAI model to use. Defaults to "text-davinci-003".
+            prompt (str): The prompt to complete.
+            model (str): The OpenAI model to use.
+            key (str): The key of the completion in the returned dictionary.
+            batch (bool, optional): Allow the prompt to be answered as part of a
+                combined "answer each" prompt with other concurrent prompts.
+                Defaults to False.
             max_tokens (int, optional): The maximum number of tokens to generate. Defaults to None.
             temperature (float, optional): The temperature to use for sampling. Defaults to 0.7.
             top_p (float, optional): The top_p value for sampling. Defaults to None.
             frequency_penalty (float, optional): The frequency penalty to use. Defaults to 0.0.
             presence_penalty (float, optional): The presence penalty to use. Defaults to 0.0.
-            stop (str, optional):  A sequence of strings to stop generation at. Defaults to None.
+            stop (str, optional): A sequence of strings to stop generation at. Defaults to None.
+            coalesce (bool, optional): Share identical in-flight requests even when
+                sampling is non-deterministic. Defaults to False.
 
         Returns:
-            Dict[str, Any]: A dictionary containing the generated text.
+            Dict[str, Any]: A dictionary containing the completion under `key`.
 
         Raises:
             HTTPException: If an error occurs during API interaction.
         """
 
+        # Batched prompts share one token budget, so only requests with an explicit
+        # max_tokens can be given a combined budget that covers every answer. Whether
+        # a prompt is batched is part of the key: an "answer each" reply must never
+        # reach a caller that asked for a plain continuation.
+        batched = batch and stop is None and max_tokens is not None
+        cache_params = (
+            key, model, max_tokens, temperature, top_p,
+            frequency_penalty, presence_penalty, stop, batched,
+        )
         try:
-            response = await self.openai_utils.generate_text(
-                prompt,
-                model,
-                max_tokens,
-                temperature,
-                top_p,
-                frequency_penalty,
-                presence_penalty,
-                stop,
-            )
-            return {"text": response.choices[0].text}
-        except openai.error.APIError as e:
+            cached = await semantic_cache.lookup(prompt, cache_params)
+            if cached is not None:
+                return cached
+            if temperature > 0 and not coalesce:
+                return await self._fetch_completion(prompt, cache_params)
+
+            inflight_key = cache_params + (prompt,)
+            task = self._inflight.get(inflight_key)
+            if task is None:
+                task = asyncio.ensure_future(self._fetch_completion(prompt, cache_params))
+                self._inflight[inflight_key] = task
+                task.add_done_callback(lambda done: self._release_inflight(inflight_key, done))
+            # Shielded so one caller disconnecting does not cancel the shared request.
+            return await asyncio.shield(task)
+        except openai.APIError as e:
             raise HTTPException(status_code=500, detail=f"OpenAI API Error: {e}")
         except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Error generating text: {e}")
+            raise HTTPException(status_code=500, detail=f"{_COMPLETION_ERRORS[key]}: {e}")
 
-    async def translate_text(
+    async def _fetch_completion(self, prompt: str, cache_params: Tuple) -> Dict[str, Any]:
+        (key, model, max_tokens, temperature, top_p,
+         frequency_penalty, presence_penalty, stop, batched) = cache_params
+        if batched and batcher.running:
+            text = await batcher.submit(
+                prompt,
+                (model, max_tokens, temperature, top_p, frequency_penalty, presence_penalty),
+            )
+        else:
+            response = await openai_utils.create_completion(
+                prompt,
+                model=model,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                top_p=top_p,
+                frequency_penalty=frequency_penalty,
+                presence_penalty=presence_penalty,
+                stop=stop,
+            )
+            text = response.choices[0].text
+        result = {key: text}
+        semantic_cache.store(prompt, cache_params, result)
+        return result
+
+    def _release_inflight(self, key: Tuple, task: asyncio.Future) -> None:
+        self._inflight.pop(key, None)
+        # Mark the exception as retrieved in case every waiter has gone away.
+        if not task.cancelled():
+            task.exception()
+
+    async def stream_completion(
         self,
-        text: str,
-        target_language: str,
-        model: str = "gpt-3.5-turbo",
-    ) -> Dict[str, Any]:
+        prompt: str,
+        *,
+        model: str,
+        max_tokens: Optional[int] = None,
+        temperature: float = 0.7,
+        top_p: Optional[float] = None,
+        frequency_penalty: float = 0.0,
+        presence_penalty: float = 0.0,
+        stop: Optional[str] = None,
+    ) -> AsyncIterator[str]:
         """
-        Translates text using the OpenAI API.
+        Streams a completion from the OpenAI API.
+
+        The request is sent before this method returns, so API errors are raised
+        before any part of a streamed response is written. Streamed completions
+        bypass the semantic cache, batching and request coalescing.
 
         Args:
-            text (str): The text to translate.
-            target_language (str): The target language code (e.g., "fr" for French).
-            model (str, optional): The OpenAI model to use. Defaults to "gpt-3.5-turbo".
+            prompt (str): The prompt to complete.
+            model (str): The OpenAI model to use.
+            max_tokens (int, optional): The maximum number of tokens to generate. Defaults to None.
+            temperature (float, optional): The temperature to use for sampling. Defaults to 0.7.
+            top_p (float, optional): The top_p value for sampling. Defaults to None.
+            frequency_penalty (float, optional): The frequency penalty to use. Defaults to 0.0.
+            presence_penalty (float, optional): The presence penalty to use. Defaults to 0.0.
+            stop (str, optional): A sequence of strings to stop generation at. Defaults to None.
 
         Returns:
-            Dict[str, Any]: A dictionary containing the translated text.
+            AsyncIterator[str]: The completion text, chunk by chunk.
 
         Raises:
             HTTPException: If an error occurs during API interaction.
         """
 
         try:
-            response = await self.openai_utils.translate_text(text, target_language, model)
-            return {"translation": response.choices[0].message.content}
-        except openai.error.APIError as e:
+            stream = await openai_utils.create_completion(
+                prompt,
+                model=model,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                top_p=top_p,
+                frequency_penalty=frequency_penalty,
+                presence_penalty=presence_penalty,
+                stop=stop,
+                stream=True,
+            )
+        except openai.APIError as e:
             raise HTTPException(status_code=500, detail=f"OpenAI API Error: {e}")
         except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Error translating text: {e}")
+            raise HTTPException(status_code=500, detail=f"Error streaming completion: {e}")
+        return _iter_deltas(stream)
+
+    async def generate_text(
+        self, prompt: str, model: str = "text-davinci-003", **kwargs
+    ) -> Dict[str, Any]:
+        """
+        Generates text using the OpenAI API.
+
+        Args:
+            prompt (str): The prompt to use for text generation.
+            model (str, optional): The OpenAI model to use. Defaults to "text-davinci-003".
+            **kwargs: The sampling, `coalesce` and `batch` options of `_completion`.
+
+        Returns:
+            Dict[str, Any]: A dictionary containing the generated text.
+
+        Raises:
+            HTTPException: If an error occurs during API interaction.
+        """
+        return await self._completion(prompt, model=model, key="text", **kwargs)
 
     async def complete_code(
-        self,
-        prompt: str,
-        model: str = "code-davinci-002",
-        max_tokens: Optional[int] = None,
-        temperature: float = 0.7,
-        top_p: Optional[float] = None,
-        frequency_penalty: float = 0.0,
-        presence_penalty: float = 0.0,
-        stop: Optional[str] = None,
+        self, prompt: str, model: str = "code-davinci-002", **kwargs
     ) -> Dict[str, Any]:
         """
         Completes code using the OpenAI API.
@@ -137,33 +459,47 @@ class OpenAIService:
         Args:
             prompt (str): The prompt to use for code completion.
             model (str, optional): The OpenAI model to use. Defaults to "code-davinci-002".
-            max_tokens (int, optional): The maximum number of tokens to generate. Defaults to None.
-            temperature (float, optional): The temperature to use for sampling. Defaults to 0.7.
-            top_p (float, optional): The top_p value for sampling. Defaults to None.
-            frequency_penalty (float, optional): The frequency penalty to use. Defaults to 0.0.
-            presence_penalty (float, optional): The presence penalty to use. Defaults to 0.0.
-            stop (str, optional): A sequence of strings to stop generation at. Defaults to None.
+            **kwargs: The sampling and `coalesce` options of `_completion`.
 
         Returns:
             Dict[str, Any]: A dictionary containing the completed code.
 
+        Raises:
+            HTTPException: If an error occurs during API interaction.
+        """
+        return await self._completion(prompt, model=model, key="code", **kwargs)
+
+    async def translate_text(
+        self,
+        text: str,
+        target_language: str,
+        model: str = "gpt-3.5-turbo",
+    ) -> Dict[str, Any]:
+        """
+        Translates text using the OpenAI API.
+
+        Args:
+            text (str): The text to translate.
+            target_language (str): The target language code (e.g., "fr" for French).
+            model (str, optional): The OpenAI model to use. Defaults to "gpt-3.5-turbo".
+
+        Returns:
+            Dict[str, Any]: A dictionary containing the translated text.
+
         Raises:
             HTTPException: If an error occurs during API interaction.
         """
 
+        cache_params = ("translate_text", model, target_language)
         try:
-            response = await self.openai_utils.complete_code(
-                prompt,
-                model,
-                max_tokens,
-                temperature,
-                top_p,
-                frequency_penalty,
-                presence_penalty,
-                stop,
-            )
-            return {"code": response.choices[0].text}
-        except openai.error.APIError as e:
+            cached = await semantic_cache.lookup(text, cache_params)
+            if cached is not None:
+                return cached
+            response = await openai_utils.translate_text(text, target_language, model)
+            result = {"translation": response.choices[0].message.content}
+            semantic_cache.store(text, cache_params, result)
+            return result
+        except openai.APIError as e:
             raise HTTPException(status_code=500, detail=f"OpenAI API Error: {e}")
         except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Error completing code: {e}")
\ No newline at end of file
+            raise HTTPException(status_code=500, detail=f"Error translating text: {e}")
@@ -0,0 +1,162 @@
+"""
+This module implements a semantic response cache for the OpenAI service.
+
+Responses are grouped under an exact-match key derived from the request parameters
+(endpoint, model, sampling settings, target language). Within a group, a prompt is
+served from the cache when it is identical to a cached prompt, or when the cosine
+similarity between its embedding and a cached prompt's embedding reaches the
+configured threshold. Repeated and near-repeated requests therefore skip the
+OpenAI round-trip entirely.
+
+The cache lives in process memory and is bounded both in the number of parameter
+groups and in the number of entries per group.
+"""
+import asyncio
+import hashlib
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import orjson
+
+from .utils import openai_utils
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+SIMILARITY_THRESHOLD = 0.97
+MAX_GROUPS = 64
+MAX_ENTRIES_PER_GROUP = 1024
+# Embeddings computed by a lookup are kept briefly so the following store can reuse them.
+RECENT_EMBEDDINGS = 256
+
+
+def _group_key(params: Tuple) -> str:
+    """Returns the sha256 exact-match key for a tuple of request parameters."""
+    return hashlib.sha256(orjson.dumps(params)).hexdigest()
+
+
+class _CacheGroup:
+    """Cached responses sharing one exact-match key."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.responses: Dict[str, Dict[str, Any]] = {}
+        self.prompts: List[str] = []
+        self.embeddings: List[np.ndarray] = []
+        self._matrix: Optional[np.ndarray] = None
+
+    def add(self, prompt: str, embedding: np.ndarray, response: Dict[str, Any]) -> None:
+        if prompt in self.responses:
+            return
+        if len(self.prompts) >= self.max_entries:
+            del self.responses[self.prompts.pop(0)]
+            self.embeddings.pop(0)
+        self.responses[prompt] = response
+        self.prompts.append(prompt)
+        self.embeddings.append(embedding)
+        self._matrix = None
+
+    def search(self, embedding: np.ndarray, threshold: float) -> Optional[Dict[str, Any]]:
+        if self._matrix is None:
+            self._matrix = np.stack(self.embeddings)
+        scores = self._matrix @ embedding
+        best = int(np.argmax(scores))
+        if scores[best] >= threshold:
+            return self.responses[self.prompts[best]]
+        return None
+
+
+class SemanticCache:
+    """
+    Embedding-keyed cache of OpenAI responses.
+
+    Lookups and stores never raise: an embedding failure is treated as a cache
+    miss, so the cache can only ever skip work, not break a request.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = True,
+        threshold: float = SIMILARITY_THRESHOLD,
+        max_groups: int = MAX_GROUPS,
+        max_entries: int = MAX_ENTRIES_PER_GROUP,
+    ):
+        """Initializes the SemanticCache."""
+        self.enabled = enabled
+        self.threshold = threshold
+        self.max_groups = max_groups
+        self.max_entries = max_entries
+        self._groups: "OrderedDict[str, _CacheGroup]" = OrderedDict()
+        self._recent: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._pending: set = set()
+
+    async def lookup(self, prompt: str, params: Tuple) -> Optional[Dict[str, Any]]:
+        """
+        Returns a cached response for a prompt, if one is close enough.
+
+        Args:
+            prompt (str): The prompt or text sent to OpenAI.
+            params (Tuple): The request parameters that must match exactly.
+
+        Returns:
+            Optional[Dict[str, Any]]: The cached response, or None on a miss.
+        """
+        if not self.enabled:
+            return None
+        group = self._groups.get(_group_key(params))
+        if group is None:
+            return None
+        response = group.responses.get(prompt)
+        if response is not None:
+            return response
+        try:
+            embedding = await self._embed(prompt)
+        except Exception:
+            return None
+        return group.search(embedding, self.threshold)
+
+    def store(self, prompt: str, params: Tuple, response: Dict[str, Any]) -> None:
+        """
+        Caches a response in the background.
+
+        The embedding request runs in a separate task so the caller does not wait
+        for it before returning the response.
+
+        Args:
+            prompt (str): The prompt or text sent to OpenAI.
+            params (Tuple): The request parameters that must match exactly.
+            response (Dict[str, Any]): The response to cache.
+        """
+        if not self.enabled:
+            return
+        task = asyncio.create_task(self._store(prompt, params, response))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def _store(self, prompt: str, params: Tuple, response: Dict[str, Any]) -> None:
+        try:
+            embedding = await self._embed(prompt)
+        except Exception:
+            return
+        key = _group_key(params)
+        group = self._groups.get(key)
+        if group is None:
+            if len(self._groups) >= self.max_groups:
+                self._groups.popitem(last=False)
+            group = self._groups[key] = _CacheGroup(self.max_entries)
+        else:
+            self._groups.move_to_end(key)
+        group.add(prompt, embedding, response)
+
+    async def _embed(self, text: str) -> np.ndarray:
+        embedding = self._recent.get(text)
+        if embedding is not None:
+            return embedding
+        vector = np.asarray(
+            await openai_utils.create_embedding(text, EMBEDDING_MODEL),
+            dtype=np.float32,
+        )
+        embedding = vector / np.linalg.norm(vector)
+        self._recent[text] = embedding
+        if len(self._recent) > RECENT_EMBEDDINGS:
+            self._recent.popitem(last=False)
+        return embedding
@@ -32,4 +32,33 @@ def test_complete_code(mock_complete_code, client):
     mock_complete_code.return_value = {"code": "print('Hello, world!')"}
     response = client.post("/api/complete_code", json={"prompt": "print('Hello, "})
     assert response.status_code == 200
-    assert response.json() == {"code": "print('Hello, world!')"}
\ No newline at end of file
+    assert response.json() == {"code": "print('Hello, world!')"}
+
+def test_generate_text_rejects_invalid_body(client):
+    response = client.post("/api/generate_text", json={"prompt": 42})
+    assert response.status_code == 422
+
+
+@patch.object(openai_service.OpenAIService, "stream_completion")
+def test_generate_text_stream(mock_stream_completion, client):
+    async def deltas():
+        yield "Hello"
+        yield ", world!"
+
+    mock_stream_completion.return_value = deltas()
+    response = client.post("/api/generate_text", json={"prompt": "Say hello.", "stream": True})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert response.text == '{"delta":"Hello"}\n{"delta":", world!"}\n'
+
+
+@patch.object(openai_service.OpenAIService, "generate_text")
+def test_generate_text_coalescing_header(mock_generate_text, client):
+    mock_generate_text.return_value = {"text": "This is some generated text."}
+    response = client.post(
+        "/api/generate_text",
+        json={"prompt": "Write a short sentence."},
+        headers={"X-Allow-Coalescing": "true"},
+    )
+    assert response.status_code == 200
+    assert mock_generate_text.call_args.kwargs["coalesce"] is True
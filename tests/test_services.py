@@ -1,8 +1,13 @@
+import asyncio
+import re
+from types import SimpleNamespace
+
 import pytest
-from unittest.mock import patch
+from fastapi import HTTPException
+from unittest.mock import AsyncMock, patch
 
 from app.utils import openai_utils
-from app.services import openai_service
+from app.services import openai_service, sem_cache
 
 # Import the OpenAI API client from the openai library
 import openai
@@ -18,46 +23,490 @@ class MockOpenAIObject:
         self.choices = choices
         self.__dict__.update(kwargs)
 
+@pytest.fixture
+def mock_client():
+    async def create_completion(*, model, **kwargs):
+        text = "print('Hello, world!')" if model == "code-davinci-002" else "This is some generated text."
+        return MockOpenAIObject(choices=[SimpleNamespace(text=text)])
+
+    translation = MockOpenAIObject(
+        choices=[SimpleNamespace(message=SimpleNamespace(content="Ceci est une traduction."))]
+    )
+    with patch.object(openai_utils.client.completions, "create", new=AsyncMock(side_effect=create_completion)), \
+            patch.object(openai_utils.client.chat.completions, "create", new=AsyncMock(return_value=translation)):
+        yield
+
 @pytest.fixture
 def mock_openai_utils():
-    with patch("app.utils.openai_utils.OpenAIUtils") as mock_utils:
-        mock_utils.return_value.generate_text.return_value = MockOpenAIObject(
-            choices=[{"text": "This is some generated text."}]
-        )
-        mock_utils.return_value.translate_text.return_value = MockOpenAIObject(
-            choices=[{"message": {"content": "Ceci est une traduction."}}]
-        )
-        mock_utils.return_value.complete_code.return_value = MockOpenAIObject(
-            choices=[{"text": "print('Hello, world!')"}]
-        )
-        yield mock_utils
+    async def create_completion(prompt, *, model, **kwargs):
+        text = "print('Hello, world!')" if model == "code-davinci-002" else "This is some generated text."
+        return MockOpenAIObject(choices=[SimpleNamespace(text=text)])
+
+    with patch("app.utils.openai_utils.create_completion", new=AsyncMock(side_effect=create_completion)), \
+            patch("app.utils.openai_utils.translate_text", new=AsyncMock(return_value=MockOpenAIObject(
+                choices=[SimpleNamespace(message=SimpleNamespace(content="Ceci est une traduction."))]
+            ))), \
+            patch.object(openai_service.semantic_cache, "enabled", False):
+        yield
 
-def test_generate_text(mock_openai_utils):
-    openai_utils_instance = openai_utils.OpenAIUtils()
-    response = openai_utils_instance.generate_text(prompt="Write a short sentence.")
+def test_generate_text(mock_client):
+    response = asyncio.run(openai_utils.generate_text(prompt="Write a short sentence."))
     assert response.choices[0].text == "This is some generated text."
 
-def test_translate_text(mock_openai_utils):
-    openai_utils_instance = openai_utils.OpenAIUtils()
-    response = openai_utils_instance.translate_text(text="This is a translation.", target_language="fr")
+def test_translate_text(mock_client):
+    response = asyncio.run(openai_utils.translate_text(text="This is a translation.", target_language="fr"))
     assert response.choices[0].message.content == "Ceci est une traduction."
 
-def test_complete_code(mock_openai_utils):
-    openai_utils_instance = openai_utils.OpenAIUtils()
-    response = openai_utils_instance.complete_code(prompt="print('Hello, ")
+def test_complete_code(mock_client):
+    response = asyncio.run(openai_utils.complete_code(prompt="print('Hello, "))
     assert response.choices[0].text == "print('Hello, world!')"
 
 def test_openai_service_generate_text(mock_openai_utils):
     service = openai_service.OpenAIService()
-    response = service.generate_text(prompt="Write a short sentence.")
+    response = asyncio.run(service.generate_text(prompt="Write a short sentence."))
     assert response["text"] == "This is some generated text."
 
 def test_openai_service_translate_text(mock_openai_utils):
     service = openai_service.OpenAIService()
-    response = service.translate_text(text="This is a translation.", target_language="fr")
+    response = asyncio.run(service.translate_text(text="This is a translation.", target_language="fr"))
     assert response["translation"] == "Ceci est une traduction."
 
 def test_openai_service_complete_code(mock_openai_utils):
     service = openai_service.OpenAIService()
-    response = service.complete_code(prompt="print('Hello, ")
-    assert response["code"] == "print('Hello, world!')"
\ No newline at end of file
+    response = asyncio.run(service.complete_code(prompt="print('Hello, "))
+    assert response["code"] == "print('Hello, world!')"
+
+def test_split_batched_answers():
+    reply = "[ab12-1] Paris\n[ab12-2] Berlin\n"
+    assert openai_service._split_answers(reply, 3, "ab12") == ["Paris", "Berlin", None]
+
+
+def test_split_batched_answers_ignores_unlabelled_markers():
+    reply = "[ab12-1] See note\n[2] a footnote\n[ab12-2] Berlin"
+    assert openai_service._split_answers(reply, 2, "ab12") == ["See note\n[2] a footnote", "Berlin"]
+
+
+def test_split_batched_answers_rejects_repeated_labels():
+    reply = "[ab12-1] Paris\n[ab12-2] Berlin\n[ab12-2] Rome"
+    assert openai_service._split_answers(reply, 2, "ab12") == ["Paris", None]
+
+
+def test_split_batched_answers_drops_truncated_answer():
+    reply = "[ab12-1] Paris\n[ab12-2] Berl"
+    assert openai_service._split_answers(reply, 2, "ab12", truncated=True) == ["Paris", None]
+
+
+class FakeCompletions:
+    """Stands in for openai_utils.create_completion, recording every upstream call."""
+
+    def __init__(self, error=None):
+        self.prompts = []
+        self.error = error
+
+    async def __call__(self, prompt, **kwargs):
+        self.prompts.append(prompt)
+        await asyncio.sleep(0.01)
+        if self.error is not None:
+            raise self.error
+        return MockOpenAIObject(choices=[SimpleNamespace(text="shared")])
+
+
+@pytest.fixture
+def upstream():
+    completions = FakeCompletions()
+    with patch("app.utils.openai_utils.create_completion", new=completions), \
+            patch.object(openai_service.semantic_cache, "enabled", False):
+        yield completions
+
+
+def test_coalesces_identical_deterministic_calls(upstream):
+    service = openai_service.OpenAIService()
+
+    async def run():
+        return await asyncio.gather(
+            service.generate_text("Hi", temperature=0),
+            service.generate_text("Hi", temperature=0),
+        )
+
+    assert asyncio.run(run()) == [{"text": "shared"}, {"text": "shared"}]
+    assert upstream.prompts == ["Hi"]
+    assert service._inflight == {}
+
+
+def test_does_not_coalesce_sampled_calls_without_opt_in(upstream):
+    service = openai_service.OpenAIService()
+
+    async def run():
+        return await asyncio.gather(
+            service.generate_text("Hi", temperature=0.7),
+            service.generate_text("Hi", temperature=0.7),
+        )
+
+    asyncio.run(run())
+    assert upstream.prompts == ["Hi", "Hi"]
+
+
+def test_coalesces_sampled_calls_with_opt_in(upstream):
+    service = openai_service.OpenAIService()
+
+    async def run():
+        return await asyncio.gather(
+            service.generate_text("Hi", temperature=0.7, coalesce=True),
+            service.generate_text("Hi", temperature=0.7, coalesce=True),
+        )
+
+    asyncio.run(run())
+    assert upstream.prompts == ["Hi"]
+
+
+def test_coalesced_failure_releases_inflight_entry(upstream):
+    upstream.error = RuntimeError("upstream failed")
+    service = openai_service.OpenAIService()
+
+    async def run():
+        return await asyncio.gather(
+            service.generate_text("Hi", temperature=0),
+            service.generate_text("Hi", temperature=0),
+            return_exceptions=True,
+        )
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, HTTPException) for result in results)
+    assert upstream.prompts == ["Hi"]
+    assert service._inflight == {}
+
+
+def test_cancelled_waiter_does_not_cancel_shared_call(upstream):
+    service = openai_service.OpenAIService()
+
+    async def run():
+        first = asyncio.ensure_future(service.generate_text("Hi", temperature=0))
+        second = asyncio.ensure_future(service.generate_text("Hi", temperature=0))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(run()) == {"text": "shared"}
+    assert upstream.prompts == ["Hi"]
+    assert service._inflight == {}
+
+
+class FakeEmbeddings:
+    """Stands in for openai_utils.create_embedding, mapping each text to a fixed vector."""
+
+    def __init__(self, vectors):
+        self.vectors = vectors
+        self.texts = []
+
+    async def __call__(self, text, model):
+        self.texts.append(text)
+        if text not in self.vectors:
+            raise RuntimeError("embedding failed")
+        return self.vectors[text]
+
+
+EMBEDDINGS = {
+    "What is the capital of France?": [1.0, 0.0],
+    "What's the capital of France?": [0.99, 0.141],
+    "What is the capital of Spain?": [0.9, 0.436],
+}
+TRANSLATE_FR = ("translate_text", "gpt-3.5-turbo", "fr")
+TRANSLATE_DE = ("translate_text", "gpt-3.5-turbo", "de")
+
+
+@pytest.fixture
+def embeddings():
+    fake = FakeEmbeddings(EMBEDDINGS)
+    with patch("app.utils.openai_utils.create_embedding", new=fake):
+        yield fake
+
+
+async def _store(cache, prompt, params, response):
+    cache.store(prompt, params, response)
+    await asyncio.gather(*cache._pending)
+
+
+def test_semantic_cache_exact_hit(embeddings):
+    cache = sem_cache.SemanticCache()
+
+    async def run():
+        await _store(cache, "What is the capital of France?", TRANSLATE_FR, {"text": "Paris"})
+        return await cache.lookup("What is the capital of France?", TRANSLATE_FR)
+
+    assert asyncio.run(run()) == {"text": "Paris"}
+    # An exact hit is answered without embedding the prompt again.
+    assert embeddings.texts == ["What is the capital of France?"]
+
+
+def test_semantic_cache_near_hit_above_threshold(embeddings):
+    cache = sem_cache.SemanticCache()
+
+    async def run():
+        await _store(cache, "What is the capital of France?", TRANSLATE_FR, {"text": "Paris"})
+        return await cache.lookup("What's the capital of France?", TRANSLATE_FR)
+
+    assert asyncio.run(run()) == {"text": "Paris"}
+
+
+def test_semantic_cache_miss_below_threshold(embeddings):
+    cache = sem_cache.SemanticCache()
+
+    async def run():
+        await _store(cache, "What is the capital of France?", TRANSLATE_FR, {"text": "Paris"})
+        return await cache.lookup("What is the capital of Spain?", TRANSLATE_FR)
+
+    assert asyncio.run(run()) is None
+
+
+def test_semantic_cache_separates_target_languages(embeddings):
+    cache = sem_cache.SemanticCache()
+
+    async def run():
+        await _store(cache, "What is the capital of France?", TRANSLATE_FR, {"text": "Paris"})
+        return (
+            await cache.lookup("What is the capital of France?", TRANSLATE_DE),
+            await cache.lookup("What's the capital of France?", TRANSLATE_DE),
+        )
+
+    assert asyncio.run(run()) == (None, None)
+
+
+def test_semantic_cache_evicts_oldest_group(embeddings):
+    cache = sem_cache.SemanticCache(max_groups=1)
+
+    async def run():
+        await _store(cache, "What is the capital of France?", TRANSLATE_FR, {"text": "Paris"})
+        await _store(cache, "What is the capital of France?", TRANSLATE_DE, {"text": "Paris"})
+        return (
+            await cache.lookup("What is the capital of France?", TRANSLATE_FR),
+            await cache.lookup("What is the capital of France?", TRANSLATE_DE),
+        )
+
+    assert asyncio.run(run()) == (None, {"text": "Paris"})
+    assert len(cache._groups) == 1
+
+
+def test_semantic_cache_evicts_oldest_entry(embeddings):
+    cache = sem_cache.SemanticCache(max_entries=1)
+
+    async def run():
+        await _store(cache, "What is the capital of France?", TRANSLATE_FR, {"text": "Paris"})
+        await _store(cache, "What is the capital of Spain?", TRANSLATE_FR, {"text": "Madrid"})
+        return (
+            await cache.lookup("What is the capital of France?", TRANSLATE_FR),
+            await cache.lookup("What is the capital of Spain?", TRANSLATE_FR),
+        )
+
+    assert asyncio.run(run()) == (None, {"text": "Madrid"})
+
+
+def test_semantic_cache_embedding_failure_is_a_miss(embeddings):
+    cache = sem_cache.SemanticCache()
+
+    async def run():
+        await _store(cache, "What is the capital of France?", TRANSLATE_FR, {"text": "Paris"})
+        await _store(cache, "Unembeddable", TRANSLATE_FR, {"text": "lost"})
+        return (
+            await cache.lookup("Unembeddable", TRANSLATE_FR),
+            await cache.lookup("Another unembeddable prompt", TRANSLATE_FR),
+        )
+
+    assert asyncio.run(run()) == (None, None)
+
+
+class FakeGenerateText:
+    """
+    Stands in for openai_utils.generate_text as called by the batcher.
+
+    A framed prompt is answered label by label through `answer`; a plain prompt
+    is continued. Every upstream call is recorded.
+    """
+
+    def __init__(self, answer=None, finish_reason="stop"):
+        self.calls = []
+        self.answer = answer or (lambda label, prompt: f"[{label}] answer to {prompt}")
+        self.finish_reason = finish_reason
+
+    async def __call__(self, prompt, **kwargs):
+        self.calls.append((prompt, kwargs))
+        await asyncio.sleep(0)
+        labels = re.findall(r"^\[(\w+-\d+)\] (.*)$", prompt, re.MULTILINE)
+        if labels:
+            text = "\n".join(self.answer(label, text) for label, text in labels)
+            finish_reason = self.finish_reason
+        else:
+            text, finish_reason = f"continued {prompt}", "stop"
+        return MockOpenAIObject(choices=[SimpleNamespace(text=text, finish_reason=finish_reason)])
+
+
+@pytest.fixture
+def generate():
+    fake = FakeGenerateText()
+    batcher = openai_service.CompletionBatcher(max_wait=0.05)
+    with patch("app.utils.openai_utils.generate_text", new=fake), \
+            patch.object(openai_service, "batcher", batcher):
+        yield fake
+
+
+def test_batched_answer_is_not_shared_with_unbatched_caller(upstream, generate):
+    service = openai_service.OpenAIService()
+
+    async def run():
+        openai_service.batcher.start()
+        try:
+            return await asyncio.gather(
+                service.generate_text("Hi", max_tokens=16, temperature=0, batch=True),
+                service.generate_text("Yo", max_tokens=16, temperature=0, batch=True),
+                service.generate_text("Hi", max_tokens=16, temperature=0),
+            )
+        finally:
+            await openai_service.batcher.stop()
+
+    assert asyncio.run(run()) == [
+        {"text": "answer to Hi"},
+        {"text": "answer to Yo"},
+        {"text": "shared"},
+    ]
+    assert len(generate.calls) == 1
+    assert upstream.prompts == ["Hi"]
+
+
+BATCH_PARAMS = ("text-davinci-003", 16, 0, None, 0.0, 0.0)
+
+
+def _run_batcher(batcher, *submissions):
+    async def run():
+        batcher.start()
+        try:
+            return await asyncio.gather(
+                *(batcher.submit(prompt, params) for prompt, params in submissions),
+                return_exceptions=True,
+            )
+        finally:
+            await batcher.stop()
+
+    return asyncio.run(run())
+
+
+def test_batcher_combines_concurrent_prompts(generate):
+    results = _run_batcher(
+        openai_service.batcher,
+        ("Hi", BATCH_PARAMS), ("Yo", BATCH_PARAMS), ("Hey", BATCH_PARAMS),
+    )
+
+    assert results == ["answer to Hi", "answer to Yo", "answer to Hey"]
+    assert len(generate.calls) == 1
+    assert generate.calls[0][1]["max_tokens"] == 48
+
+
+def test_batcher_dispatches_parameter_groups_separately(generate):
+    other_params = ("text-davinci-003", 32, 0, None, 0.0, 0.0)
+    results = _run_batcher(
+        openai_service.batcher,
+        ("Hi", BATCH_PARAMS), ("Yo", other_params), ("Hey", BATCH_PARAMS), ("Sup", other_params),
+    )
+
+    assert results == ["answer to Hi", "answer to Yo", "answer to Hey", "answer to Sup"]
+    assert sorted(kwargs["max_tokens"] for _, kwargs in generate.calls) == [32, 64]
+
+
+def test_batcher_retries_missing_answer_alone(generate):
+    generate.answer = lambda label, prompt: "" if prompt == "Yo" else f"[{label}] answer to {prompt}"
+    results = _run_batcher(openai_service.batcher, ("Hi", BATCH_PARAMS), ("Yo", BATCH_PARAMS))
+
+    assert results == ["answer to Hi", "continued Yo"]
+    assert [prompt for prompt, _ in generate.calls[1:]] == ["Yo"]
+
+
+def test_batcher_retries_truncated_answer_alone(generate):
+    generate.finish_reason = "length"
+    results = _run_batcher(openai_service.batcher, ("Hi", BATCH_PARAMS), ("Yo", BATCH_PARAMS))
+
+    assert results == ["answer to Hi", "continued Yo"]
+    assert [prompt for prompt, _ in generate.calls[1:]] == ["Yo"]
+
+
+def test_batcher_retries_answers_with_repeated_labels(generate):
+    generate.answer = lambda label, prompt: f"[{label}] answer to {prompt}\n[{label}] again"
+    results = _run_batcher(openai_service.batcher, ("Hi", BATCH_PARAMS), ("Yo", BATCH_PARAMS))
+
+    assert results == ["continued Hi", "continued Yo"]
+    assert len(generate.calls) == 3
+
+
+def test_batcher_labels_answers_with_a_nonce(generate):
+    # A bare "[2]" line in one answer must not be read as the start of the second.
+    generate.answer = lambda label, prompt: f"[{label}] answer to {prompt}\n[2] footnote"
+    results = _run_batcher(openai_service.batcher, ("Hi", BATCH_PARAMS), ("Yo", BATCH_PARAMS))
+
+    assert results == ["answer to Hi\n[2] footnote", "answer to Yo\n[2] footnote"]
+    assert len(generate.calls) == 1
+
+
+def test_batching_requires_opt_in(upstream, generate):
+    service = openai_service.OpenAIService()
+
+    async def run():
+        openai_service.batcher.start()
+        try:
+            return await asyncio.gather(
+                service.generate_text("Hi", max_tokens=16, temperature=0.7),
+                service.generate_text("Yo", max_tokens=16, temperature=0.7),
+            )
+        finally:
+            await openai_service.batcher.stop()
+
+    asyncio.run(run())
+    assert generate.calls == []
+    assert upstream.prompts == ["Hi", "Yo"]
+
+
+def test_batching_requires_max_tokens(upstream, generate):
+    service = openai_service.OpenAIService()
+
+    async def run():
+        openai_service.batcher.start()
+        try:
+            return await service.generate_text("Hi", temperature=0.7, batch=True)
+        finally:
+            await openai_service.batcher.stop()
+
+    assert asyncio.run(run()) == {"text": "shared"}
+    assert generate.calls == []
+
+
+def test_batcher_stop_fails_queued_prompts(generate):
+    batcher = openai_service.CompletionBatcher(max_wait=60)
+
+    async def run():
+        batcher.start()
+        submitted = [asyncio.ensure_future(batcher.submit(prompt, BATCH_PARAMS)) for prompt in ("Hi", "Yo")]
+        await asyncio.sleep(0.01)
+        await batcher.stop()
+        return await asyncio.gather(*submitted, return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert generate.calls == []
+
+
+def test_batcher_stop_fails_in_flight_prompts(generate):
+    started = []
+
+    async def hang(prompt, **kwargs):
+        started.append(prompt)
+        await asyncio.Event().wait()
+
+    batcher = openai_service.CompletionBatcher(max_wait=0.01)
+
+    async def run():
+        batcher.start()
+        submitted = [asyncio.ensure_future(batcher.submit(prompt, BATCH_PARAMS)) for prompt in ("Hi", "Yo")]
+        while not started:
+            await asyncio.sleep(0.01)
+        await batcher.stop()
+        return await asyncio.gather(*submitted, return_exceptions=True)
+
+    with patch("app.utils.openai_utils.generate_text", new=hang):
+        results = asyncio.run(run())
+    assert all(isinstance(result, RuntimeError) for result in results)
@@ -1,8 +1,10 @@
+import asyncio
+from types import SimpleNamespace
+
 import pytest
-from unittest.mock import patch
+from unittest.mock import AsyncMock, patch
 
 from app.utils import openai_utils
-from app.services import openai_service
 
 # Import the OpenAI API client from the openai library
 import openai
@@ -19,45 +21,44 @@ class MockOpenAIObject:
         self.__dict__.update(kwargs)
 
 @pytest.fixture
-def mock_openai_utils():
-    with patch("app.utils.openai_utils.OpenAIUtils") as mock_utils:
-        mock_utils.return_value.generate_text.return_value = MockOpenAIObject(
-            choices=[{"text": "This is some generated text."}]
-        )
-        mock_utils.return_value.translate_text.return_value = MockOpenAIObject(
-            choices=[{"message": {"content": "Ceci est une traduction."}}]
-        )
-        mock_utils.return_value.complete_code.return_value = MockOpenAIObject(
-            choices=[{"text": "print('Hello, world!')"}]
-        )
-        yield mock_utils
-
-def test_generate_text(mock_openai_utils):
-    openai_utils_instance = openai_utils.OpenAIUtils()
-    response = openai_utils_instance.generate_text(prompt="Write a short sentence.")
+def mock_client():
+    async def create_completion(*, model, **kwargs):
+        text = "print('Hello, world!')" if model == "code-davinci-002" else "This is some generated text."
+        return MockOpenAIObject(choices=[SimpleNamespace(text=text)])
+
+    translation = MockOpenAIObject(
+        choices=[SimpleNamespace(message=SimpleNamespace(content="Ceci est une traduction."))]
+    )
+    with patch.object(openai_utils.client.completions, "create", new=AsyncMock(side_effect=create_completion)), \
+            patch.object(openai_utils.client.chat.completions, "create", new=AsyncMock(return_value=translation)):
+        yield
+
+def test_generate_text(mock_client):
+    response = asyncio.run(openai_utils.generate_text(prompt="Write a short sentence."))
     assert response.choices[0].text == "This is some generated text."
 
-def test_translate_text(mock_openai_utils):
-    openai_utils_instance = openai_utils.OpenAIUtils()
-    response = openai_utils_instance.translate_text(text="This is a translation.", target_language="fr")
+def test_translate_text(mock_client):
+    response = asyncio.run(openai_utils.translate_text(text="This is a translation.", target_language="fr"))
     assert response.choices[0].message.content == "Ceci est une traduction."
 
-def test_complete_code(mock_openai_utils):
-    openai_utils_instance = openai_utils.OpenAIUtils()
-    response = openai_utils_instance.complete_code(prompt="print('Hello, ")
+def test_complete_code(mock_client):
+    response = asyncio.run(openai_utils.complete_code(prompt="print('Hello, "))
     assert response.choices[0].text == "print('Hello, world!')"
 
-def test_openai_service_generate_text(mock_openai_utils):
-    service = openai_service.OpenAIService()
-    response = service.generate_text(prompt="Write a short sentence.")
-    assert response["text"] == "This is some generated text."
+def test_cap_max_tokens_skips_tokenizing_short_prompts():
+    with patch("app.utils.openai_utils.count_tokens", new=AsyncMock()) as count_tokens:
+        assert asyncio.run(openai_utils._cap_max_tokens("Hi", "text-davinci-003", 256)) == 256
+    count_tokens.assert_not_called()
 
-def test_openai_service_translate_text(mock_openai_utils):
-    service = openai_service.OpenAIService()
-    response = service.translate_text(text="This is a translation.", target_language="fr")
-    assert response["translation"] == "Ceci est une traduction."
+def test_cap_max_tokens_fits_context_window():
+    prompt = "x" * 5000
+    with patch("app.utils.openai_utils.count_tokens", new=AsyncMock(return_value=4000)):
+        assert asyncio.run(openai_utils._cap_max_tokens(prompt, "text-davinci-003", 256)) == 97
+    with patch("app.utils.openai_utils.count_tokens", new=AsyncMock(return_value=1000)):
+        assert asyncio.run(openai_utils._cap_max_tokens(prompt, "text-davinci-003", 256)) == 256
+    with patch("app.utils.openai_utils.count_tokens", new=AsyncMock(return_value=5000)):
+        assert asyncio.run(openai_utils._cap_max_tokens(prompt, "text-davinci-003", 256)) == 1
 
-def test_openai_service_complete_code(mock_openai_utils):
-    service = openai_service.OpenAIService()
-    response = service.complete_code(prompt="print('Hello, ")
-    assert response["code"] == "print('Hello, world!')"
\ No newline at end of file
+def test_cap_max_tokens_leaves_max_tokens_when_tokenizer_unavailable():
+    with patch("app.utils.openai_utils.count_tokens", new=AsyncMock(side_effect=OSError("offline"))):
+        assert asyncio.run(openai_utils._cap_max_tokens("x" * 5000, "text-davinci-003", 256)) == 256
@@ -1,164 +1,212 @@
 """
 This module provides utility functions for interacting with the OpenAI API.
 
-It encapsulates common logic for sending requests, processing responses,
-and handling errors, making it easier to integrate OpenAI capabilities
-within other components of the MVP.
+It encapsulates common logic for sending requests through a shared client,
+making it easier to integrate OpenAI capabilities within other components of
+the MVP. Errors are left to propagate; the service layer converts them into
+HTTP errors.
 
 This module adheres to the following design principles:
 
 - Modularity:  Encapsulates API-related logic, making the codebase more organized and reusable.
 - Abstraction:  Provides a clean interface for other components to interact with the OpenAI API.
-- Robustness:  Implements error handling for potential API failures and data inconsistencies.
 - Scalability:  The code is designed for future expansion and handling increased request volumes.
 """
 
-import os
-from typing import Dict, Any, Optional
+import asyncio
+import functools
+from typing import List, Optional, Union
 
+import httpx
 import openai
-from fastapi import HTTPException
+import tiktoken
+from openai import AsyncStream
+from openai.types import Completion
+from openai.types.chat import ChatCompletion
 
 # Load environment variables from .env
 from .config import Config
 
-# Initialize the OpenAI API client
-openai.api_key = Config.OPENAI_API_KEY
+# Initialize the shared OpenAI API client. A single pooled HTTP/2 client keeps
+# connections alive between calls and multiplexes concurrent requests over them
+# instead of paying TCP and TLS setup each time; it is closed by the application
+# shutdown hook.
+client = openai.AsyncOpenAI(
+    api_key=Config.OPENAI_API_KEY,
+    http_client=openai.DefaultAsyncHttpxClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=100, max_connections=200),
+        timeout=httpx.Timeout(30, connect=5),
+    ),
+)
+
+# Context window (prompt + completion tokens) of the completion models whose
+# max_tokens is capped to fit the prompt.
+CONTEXT_WINDOWS = {
+    "text-davinci-003": 4097,
+    "code-davinci-002": 8001,
+}
+
+@functools.lru_cache(maxsize=None)
+def _get_encoder(model: str) -> tiktoken.Encoding:
+    """
+    Returns the tokenizer for a model, building it on first use.
 
-class OpenAIUtils:
+    Building a tokenizer loads (and, on a cold cache, downloads) its BPE ranks,
+    which is far too slow to repeat per request and must not happen at import.
+    """
+    return tiktoken.encoding_for_model(model)
+
+def _count_tokens_sync(text: str, model: str) -> int:
+    return len(_get_encoder(model).encode_ordinary(text))
+
+# Fixed system turn shared by every translation request, kept byte-for-byte
+# identical with the volatile fields placed last in the user turn. OpenAI only
+# caches prompt prefixes once a prompt exceeds 1024 tokens, and this turn is about
+# 130, so short translations get no caching today; the stable prefix only pays
+# off for texts long enough to push the whole prompt past that threshold.
+TRANSLATION_SYSTEM_PROMPT = (
+    "You are a translation engine. Translate the text supplied by the user into "
+    "the target language named on the last line of the message, after the '---' "
+    "separator. Reply with only the translated text: no explanations, notes, "
+    "quotation marks or transliterations. Preserve the original formatting, "
+    "including line breaks, whitespace, Markdown, lists, code blocks, URLs and "
+    "placeholders such as {name} or %s, and leave code, identifiers and proper "
+    "nouns untranslated unless they have a well-established translation. Keep the "
+    "tone and register of the source text. If the text is already in the target "
+    "language, return it unchanged."
+)
+
+async def count_tokens(text: str, model: str) -> Optional[int]:
     """
-    Provides a utility class for interacting with the OpenAI API.
+    Counts the tokens in text for a model.
+
+    Tokenizing long prompts, and building the tokenizer on first use, is slow
+    and blocking, so both run in the default executor instead of blocking the
+    event loop.
+
+    Args:
+        text (str): The text to tokenize.
+        model (str): The OpenAI model whose tokenizer to use.
 
-    This class handles API calls, data transformations, and error handling.
+    Returns:
+        Optional[int]: The number of tokens, or None if the model has no known tokenizer.
     """
+    if model not in CONTEXT_WINDOWS:
+        return None
+    return await asyncio.get_running_loop().run_in_executor(None, _count_tokens_sync, text, model)
+
+async def _cap_max_tokens(prompt: str, model: str, max_tokens: Optional[int]) -> Optional[int]:
+    """Lowers max_tokens so that prompt and completion fit the model's context window."""
+    if max_tokens is None or model not in CONTEXT_WINDOWS:
+        return max_tokens
+    # Every token covers at least one byte, so a prompt whose UTF-8 length already
+    # fits alongside max_tokens cannot overflow the window and needs no tokenizing.
+    if len(prompt.encode()) + max_tokens <= CONTEXT_WINDOWS[model]:
+        return max_tokens
+    try:
+        prompt_tokens = await count_tokens(prompt, model)
+    except Exception:
+        # Capping is only an optimisation. If the tokenizer cannot be loaded (its
+        # BPE file is downloaded on first use), send the request uncapped.
+        return max_tokens
+    return max(1, min(max_tokens, CONTEXT_WINDOWS[model] - prompt_tokens))
+
+async def create_completion(
+    prompt: str,
+    *,
+    model: str,
+    max_tokens: Optional[int] = None,
+    temperature: float = 0.7,
+    top_p: Optional[float] = None,
+    frequency_penalty: float = 0.0,
+    presence_penalty: float = 0.0,
+    stop: Optional[str] = None,
+    stream: bool = False,
+) -> Union[Completion, AsyncStream[Completion]]:
+    """
+    Creates a completion using the OpenAI API.
+
+    Args:
+        prompt (str): The prompt to complete.
+        model (str): The OpenAI model to use.
+        max_tokens (int, optional): The maximum number of tokens to generate, capped to
+            the room left in the model's context window. Defaults to None.
+        temperature (float, optional): The temperature to use for sampling. Defaults to 0.7.
+        top_p (float, optional): The top_p value for sampling. Defaults to None.
+        frequency_penalty (float, optional): The frequency penalty to use. Defaults to 0.0.
+        presence_penalty (float, optional): The presence penalty to use. Defaults to 0.0.
+        stop (str, optional): A sequence of strings to stop generation at. Defaults to None.
+        stream (bool, optional): Stream the completion as it is generated. Defaults to False.
+
+    Returns:
+        Union[Completion, AsyncStream[Completion]]: The response from the OpenAI API, or
+            a stream of partial completions when `stream` is set.
+
+    Raises:
+        openai.APIError: If an error occurs during API interaction.
+    """
+    max_tokens = await _cap_max_tokens(prompt, model, max_tokens)
+    return await client.completions.create(
+        model=model,
+        prompt=prompt,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        top_p=top_p,
+        frequency_penalty=frequency_penalty,
+        presence_penalty=presence_penalty,
+        stop=stop,
+        stream=stream,
+    )
+
+# Text generation and code completion differ only in their default model; both
+# take the keyword arguments of `create_completion`.
+generate_text = functools.partial(create_completion, model="text-davinci-003")
+complete_code = functools.partial(create_completion, model="code-davinci-002")
+
+async def translate_text(
+    text: str,
+    target_language: str,
+    model: str = "gpt-3.5-turbo",
+) -> ChatCompletion:
+    """
+    Translates text using the OpenAI API.
+
+    Args:
+        text (str): The text to translate.
+        target_language (str): The target language code (e.g., "fr" for French).
+        model (str, optional): The OpenAI model to use. Defaults to "gpt-3.5-turbo".
 
-    def __init__(self):
-        """Initializes the OpenAIUtils class."""
-        pass
-
-    async def generate_text(
-        self,
-        prompt: str,
-        model: str = "text-davinci-003",
-        max_tokens: Optional[int] = None,
-        temperature: float = 0.7,
-        top_p: Optional[float] = None,
-        frequency_penalty: float = 0.0,
-        presence_penalty: float = 0.0,
-        stop: Optional[str] = None,
-    ) -> openai.OpenAIObject:
-        """
-        Generates text using the OpenAI API.
-
-        Args:
-            prompt (str): The prompt to use for text generation.
-            model (str, optional): The OpenAI model to use. Defaults to "text-davinci-003".
-            max_tokens (int, optional): The maximum number of tokens to generate. Defaults to None.
-            temperature (float, optional): The temperature to use for sampling. Defaults to 0.7.
-            top_p (float, optional): The top_p value for sampling. Defaults to None.
-            frequency_penalty (float, optional): The frequency penalty to use. Defaults to 0.0.
-            presence_penalty (float, optional): The presence penalty to use. Defaults to 0.0.
-            stop (str, optional): A sequence of strings to stop generation at. Defaults to None.
-
-        Returns:
-            openai.OpenAIObject: The response from the OpenAI API.
-
-        Raises:
-            HTTPException: If an error occurs during API interaction.
-        """
-        try:
-            response = await openai.Completion.create(
-                engine=model,
-                prompt=prompt,
-                max_tokens=max_tokens,
-                temperature=temperature,
-                top_p=top_p,
-                frequency_penalty=frequency_penalty,
-                presence_penalty=presence_penalty,
-                stop=stop,
-            )
-            return response
-        except openai.error.APIError as e:
-            raise HTTPException(status_code=500, detail=f"OpenAI API Error: {e}")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Error generating text: {e}")
-
-    async def translate_text(
-        self,
-        text: str,
-        target_language: str,
-        model: str = "gpt-3.5-turbo",
-    ) -> openai.OpenAIObject:
-        """
-        Translates text using the OpenAI API.
-
-        Args:
-            text (str): The text to translate.
-            target_language (str): The target language code (e.g., "fr" for French).
-            model (str, optional): The OpenAI model to use. Defaults to "gpt-3.5-turbo".
-
-        Returns:
-            openai.OpenAIObject: The response from the OpenAI API.
-
-        Raises:
-            HTTPException: If an error occurs during API interaction.
-        """
-        try:
-            response = await openai.ChatCompletion.create(
-                model=model,
-                messages=[
-                    {"role": "user", "content": f"Translate this text into {target_language}: {text}"},
-                ],
-            )
-            return response
-        except openai.error.APIError as e:
-            raise HTTPException(status_code=500, detail=f"OpenAI API Error: {e}")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Error translating text: {e}")
-
-    async def complete_code(
-        self,
-        prompt: str,
-        model: str = "code-davinci-002",
-        max_tokens: Optional[int] = None,
-        temperature: float = 0.7,
-        top_p: Optional[float] = None,
-        frequency_penalty: float = 0.0,
-        presence_penalty: float = 0.0,
-        stop: Optional[str] = None,
-    ) -> openai.OpenAIObject:
-        """
-        Completes code using the OpenAI API.
-
-        Args:
-            prompt (str): The prompt to use for code completion.
-            model (str, optional): The OpenAI model to use. Defaults to "code-davinci-002".
-            max_tokens (int, optional): The maximum number of tokens to generate. Defaults to None.
-            temperature (float, optional): The temperature to use for sampling. Defaults to 0.7.
-            top_p (float, optional): The top_p value for sampling. Defaults to None.
-            frequency_penalty (float, optional): The frequency penalty to use. Defaults to 0.0.
-            presence_penalty (float, optional): The presence penalty to use. Defaults to 0.0.
-            stop (str, optional): A sequence of strings to stop generation at. Defaults to None.
-
-        Returns:
-            openai.OpenAIObject: The response from the OpenAI API.
-
-        Raises:
-            HTTPException: If an error occurs during API interaction.
-        """
-        try:
-            response = await openai.Completion.create(
-                engine=model,
-                prompt=prompt,
-                max_tokens=max_tokens,
-                temperature=temperature,
-                top_p=top_p,
-                frequency_penalty=frequency_penalty,
-                presence_penalty=presence_penalty,
-                stop=stop,
-            )
-            return response
-        except openai.error.APIError as e:
-            raise HTTPException(status_code=500, detail=f"OpenAI API Error: {e}")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Error completing code: {e}")
\ No newline at end of file
+    Returns:
+        ChatCompletion: The response from the OpenAI API.
+
+    Raises:
+        openai.APIError: If an error occurs during API interaction.
+    """
+    return await client.chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": TRANSLATION_SYSTEM_PROMPT},
+            {"role": "user", "content": f"{text}\n---\nTarget language: {target_language}"},
+        ],
+    )
+
+async def create_embedding(
+    text: str,
+    model: str = "text-embedding-3-small",
+) -> List[float]:
+    """
+    Creates an embedding vector for text using the OpenAI API.
+
+    Args:
+        text (str): The text to embed.
+        model (str, optional): The OpenAI embedding model to use. Defaults to "text-embedding-3-small".
+
+    Returns:
+        List[float]: The embedding vector.
+
+    Raises:
+        openai.APIError: If an error occurs during API interaction.
+    """
+    response = await client.embeddings.create(model=model, input=text)
+    return response.data[0].embedding